@@ -1,46 +1,138 @@
 import os
+import subprocess
+from collections.abc import Iterable
 
 from rclone_python import rclone
+from stream_unzip import NotStreamUnzippable, stream_unzip
 
 from src.logger import get_logger
+from src.utils import unzip_dataset
 
 logger = get_logger("ultralytics_gdrive_ops")
 
+STREAM_BUFFER_SIZE = 8 << 20
+STREAM_CHUNK_SIZE = 1 << 20
 
-def check_for_new_files(path: str, current_files: list[str], is_gdrive: bool = True) -> list[str]:
+# rclone flags. `rclone cat` reads datasets as a single stream, `rclone copy` downloads archives that cannot be
+# streamed with parallel range requests, and log uploads favour many transfers of small files. Drive buffers one
+# --drive-chunk-size chunk (8M by default) per uploading transfer, so the default is kept to bound memory use.
+STREAM_ARGS = ["--buffer-size=64M"]
+DOWNLOAD_ARGS = ["--multi-thread-streams=8", "--multi-thread-cutoff=16M"]
+COPY_ARGS = ["--transfers=16", "--checkers=8"]
+SYNC_ARGS = ["--fast-list", "--transfers=16", "--checkers=32", "--drive-pacer-min-sleep=10ms"]
+
+
+def check_for_new_files(path: str, current_files: Iterable[str], is_gdrive: bool = True) -> list[str]:
     """
     Check for new files in the Google Drive directory based on the file names.
     """
     logger.info(f"Checking for new files in {path}")
     if is_gdrive:
-        all_gdrive_files = rclone.ls(path)
+        all_filenames = [file['Path'] for file in rclone.ls(path)]
     else:
-        all_gdrive_files = os.listdir(path)
-
-    new_files = []
-    for file in all_gdrive_files:
-        if is_gdrive:
-            filename = file['Path']
-        else:
-            filename = file
-        if filename not in current_files:
-            new_files.append(filename)
+        with os.scandir(path) as it:
+            all_filenames = [entry.name for entry in it]
+
+    if not isinstance(current_files, (set, frozenset)):
+        current_files = set(current_files)
+    new_files = [filename for filename in all_filenames if filename not in current_files]
     logger.info(f"Found {len(new_files)} new files in {path}: {new_files}")
     return new_files
 
 
-def download_file(gdrive_path: str, local_path: str, show_progress: bool = False):
+def download_file(gdrive_path: str, local_path: str, show_progress: bool = False, args: list[str] | None = None):
     """
     Download a file from Google Drive to the local directory.
     """
     logger.info(f"Downloading {gdrive_path} to {local_path}...")
-    rclone.copy(gdrive_path, local_path, ignore_existing=False, show_progress=show_progress)
+    rclone.copy(
+        gdrive_path,
+        local_path,
+        ignore_existing=False,
+        show_progress=show_progress,
+        args=DOWNLOAD_ARGS if args is None else args
+    )
     logger.info(f"Downloaded {gdrive_path} to {local_path}")
 
     filename = os.path.basename(gdrive_path)
     return os.path.join(local_path, filename)
 
 
+def download_and_extract(
+    gdrive_path: str,
+    local_path: str,
+    stream_args: list[str] | None = None,
+    download_args: list[str] | None = None
+) -> str:
+    """
+    Stream a zip file from Google Drive and extract it on the fly, without writing the archive to disk.
+    Archives that cannot be unzipped as a stream are downloaded and extracted from disk instead.
+    `stream_args` and `download_args` override the rclone flags of each path.
+    """
+    logger.info(f"Downloading and extracting {gdrive_path} to {local_path}...")
+    try:
+        _stream_extract(gdrive_path, local_path, stream_args)
+    except NotStreamUnzippable as e:
+        logger.warning(f"{gdrive_path} cannot be unzipped as a stream ({e!r}), downloading it first")
+        zip_path = download_file(gdrive_path, local_path, args=download_args)
+        try:
+            if not unzip_dataset(zip_path, local_path):
+                raise ValueError(f"Could not extract {zip_path}")
+        finally:
+            os.remove(zip_path)
+
+    logger.info(f"Downloaded and extracted {gdrive_path} to {local_path}")
+
+    filename = os.path.basename(gdrive_path)
+    return os.path.join(local_path, os.path.splitext(filename)[0])
+
+
+def _stream_extract(gdrive_path: str, local_path: str, args: list[str] | None = None):
+    """
+    Pipe `rclone cat` into stream-unzip, writing the entries as they arrive.
+    """
+    extract_dir = os.path.realpath(local_path)
+    cmd = ["rclone", "cat", *(STREAM_ARGS if args is None else args), gdrive_path]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=STREAM_BUFFER_SIZE)
+
+    def iter_chunks():
+        while chunk := proc.stdout.read(STREAM_CHUNK_SIZE):
+            yield chunk
+
+    try:
+        for file_name, _, unzipped_chunks in stream_unzip(iter_chunks()):
+            try:
+                file_name = file_name.decode("utf-8")
+            except UnicodeDecodeError:
+                file_name = file_name.decode("cp437")
+
+            target_path = os.path.realpath(os.path.join(extract_dir, file_name))
+            if os.path.commonpath([extract_dir, target_path]) != extract_dir:
+                raise ValueError(f"Refusing to extract {file_name} outside of {local_path}")
+
+            # every entry must be fully consumed before moving on to the next one
+            if file_name.endswith("/"):
+                os.makedirs(target_path, exist_ok=True)
+                for _ in unzipped_chunks:
+                    pass
+                continue
+
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            with open(target_path, "wb") as f:
+                for chunk in unzipped_chunks:
+                    f.write(chunk)
+    except BaseException:
+        # stop the download, nothing more will be read from it
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"rclone cat {gdrive_path} failed with exit code {proc.returncode}")
+
+
 def upload_file(local_path: str, gdrive_path: str):
     """
     Upload a file to Google Drive.
@@ -48,9 +140,22 @@ def upload_file(local_path: str, gdrive_path: str):
     rclone.copy(local_path, gdrive_path, ignore_existing=False)
 
 
-def sync_folder(source_path: str, target_path: str, show_progress: bool = False):
+def sync_folder(source_path: str, target_path: str, show_progress: bool = False, args: list[str] | None = None):
     """
     Sync a folder to Google Drive.
     """
     logger.info(f"Syncing {source_path} to {target_path}...")
-    rclone.sync(source_path, target_path, show_progress=show_progress)
\ No newline at end of file
+    rclone.sync(source_path, target_path, show_progress=show_progress, args=SYNC_ARGS if args is None else args)
+
+
+def copy_folder(source_path: str, target_path: str, show_progress: bool = False, args: list[str] | None = None):
+    """
+    Copy new and updated files of a folder (or a single file) to Google Drive, without deleting anything on the remote.
+    """
+    logger.info(f"Copying updates from {source_path} to {target_path}...")
+    rclone.copy(
+        source_path,
+        target_path,
+        show_progress=show_progress,
+        args=["--update", *(COPY_ARGS if args is None else args)]
+    )
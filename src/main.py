@@ -1,16 +1,47 @@
+import multiprocessing as mp
 import os
-import subprocess
+import queue
 import sys
 import threading
 import time
+from collections import deque
 
-from src.gdrive_ops import check_for_new_files, download_file, sync_folder
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+from src.gdrive_ops import check_for_new_files, copy_folder, download_and_extract, sync_folder
 from src.logger import setup_logger
-from src.train import Trainer
+from src.train import TrainCfg, Trainer, training_worker_loop
+from src.utils import check_dataset_structure, get_path_fingerprint
 
 logger = setup_logger("ultralytics_gdrive_ops")
 
 MONITORING_INTERVAL = 10
+PREPARED_QUEUE_SIZE = 2
+SYNC_INTERVAL = 1200
+SYNC_DEBOUNCE_INTERVAL = 30
+TRAINING_CHECK_INTERVAL = 60
+
+
+class _ChangeEventHandler(FileSystemEventHandler):
+    """
+    Set an event whenever a file is written, created, moved or deleted in the watched folder.
+    Open/close events are ignored, otherwise rclone reading the files would trigger another sync.
+    """
+    def __init__(self, changed: threading.Event):
+        self.changed = changed
+
+    def on_created(self, event):
+        self.changed.set()
+
+    def on_modified(self, event):
+        self.changed.set()
+
+    def on_moved(self, event):
+        self.changed.set()
+
+    def on_deleted(self, event):
+        self.changed.set()
 
 
 class TrainManager:
@@ -19,18 +50,49 @@ class TrainManager:
         local_dataset_path: str,
         local_model_logs_path: str,
         gdrive_dataset_path: str,
-        gdrive_model_logs_path: str
+        gdrive_model_logs_path: str,
+        stream_args: list[str] | None = None,
+        download_args: list[str] | None = None,
+        copy_args: list[str] | None = None,
+        sync_args: list[str] | None = None,
+        train_cfg: TrainCfg | None = None,
+        auto_tune_train_cfg: bool = False
     ):
         """
         Initialize the TrainManager.
+
+        `train_cfg` holds the YOLO hyperparameters of every training. With `auto_tune_train_cfg`, it is
+        specialized per dataset, see `TrainCfg.specialize`.
+
+        `stream_args`, `download_args`, `copy_args` and `sync_args` override the rclone flags used to stream
+        datasets with `rclone cat`, to download the datasets that cannot be streamed, to upload model logs
+        during training and to sync them after training, so they can be tuned to the link. Defaults are
+        used when they are None.
         """
         self.local_dataset_path = local_dataset_path
         self.local_model_logs_path = local_model_logs_path
         self.gdrive_dataset_path = gdrive_dataset_path
         self.gdrive_model_logs_path = gdrive_model_logs_path
+        self.stream_args = stream_args
+        self.download_args = download_args
+        self.copy_args = copy_args
+        self.sync_args = sync_args
+        self.train_cfg = train_cfg or TrainCfg()
+        self.auto_tune_train_cfg = auto_tune_train_cfg
 
-        self.training_queue = []
-        self.stop_sync_thread = False
+        self.training_queue = deque()
+        self.prepared_queue = queue.Queue(maxsize=PREPARED_QUEUE_SIZE)
+        self.stop_sync_event = threading.Event()
+        self.stop_download_event = threading.Event()
+        self.stop_monitoring_event = threading.Event()
+        self.model_logs_changed = threading.Event()
+        self.model_logs_observer = None
+        self.full_sync_pending = threading.Event()
+        self.mp_context = mp.get_context("spawn")
+        self.training_task_queue = None
+        self.training_done_queue = None
+        self.training_worker = None
+        self.current_run_name = None
 
         self._initialize()
 
@@ -38,130 +100,302 @@ class TrainManager:
         """
         Get the current dataset paths and model logs in Google Drive.
         """
-        self.current_local_dataset_paths = check_for_new_files(self.local_dataset_path, [], is_gdrive=False)
-        self.current_gdrive_dataset_paths = check_for_new_files(self.gdrive_dataset_path, [])
-        self.current_local_model_logs = check_for_new_files(self.local_model_logs_path, [], is_gdrive=False)
-        self.current_gdrive_model_logs = check_for_new_files(self.gdrive_model_logs_path, [])
+        self.current_local_dataset_paths = set(check_for_new_files(self.local_dataset_path, set(), is_gdrive=False))
+        self.current_gdrive_dataset_paths = set(check_for_new_files(self.gdrive_dataset_path, set()))
+        self.current_local_model_logs = set(check_for_new_files(self.local_model_logs_path, set(), is_gdrive=False))
+        self.current_gdrive_model_logs = set(check_for_new_files(self.gdrive_model_logs_path, set()))
 
     def start(self):
         """
         Start the monitoring process.
         """
         logger.info("Starting receiving new datasets from Google Drive...")
+        self.training_worker = self._start_training_worker()
         sync_thread = self._sync_model_logs_loop()
+        download_thread = self._downloader_loop()
+        monitoring_thread = self._monitoring_loop()
 
         try:
             while True:
-                # Check for new datasets
-                self._check_and_update_datasets()
-
-                # Start new training if queue has items
-                if not self.training_queue:
+                # Wait for the downloader thread to hand over a prepared dataset
+                try:
+                    dataset_path = self.prepared_queue.get(timeout=MONITORING_INTERVAL)
+                except queue.Empty:
                     logger.info(f"No new datasets to train. Training queue: {self.training_queue}")
-                    time.sleep(MONITORING_INTERVAL)
                     continue
 
-                # Process next dataset in queue
-                self._process_next_dataset()
+                # Train on the prepared dataset
+                self._process_next_dataset(dataset_path)
 
         except KeyboardInterrupt:
             logger.info("Keyboard interrupt received. Exiting...")
-            self._cleanup(sync_thread, None)
+            self._cleanup(sync_thread, self.training_worker, download_thread, monitoring_thread)
             sys.exit(0)
         except Exception as e:
             logger.error(f"Error during training: {e}")
-            self._cleanup(sync_thread, None)
+            self._cleanup(sync_thread, self.training_worker, download_thread, monitoring_thread)
             sys.exit(1)
 
     def _check_and_update_datasets(self):
         """Check for new datasets and add them to the training queue."""
         new_dataset_files = check_for_new_files(self.gdrive_dataset_path, self.current_gdrive_dataset_paths)
-        self.current_gdrive_dataset_paths += new_dataset_files
-        self.training_queue += new_dataset_files
+        self.current_gdrive_dataset_paths.update(new_dataset_files)
+        self.training_queue.extend(new_dataset_files)
 
-    def _process_next_dataset(self):
-        """Process the next dataset in the queue and start training."""
-        new_dataset = self.training_queue.pop(0)
+    def _prepare_next_dataset(self) -> str | None:
+        """Download and prepare the next dataset in the queue."""
+        new_dataset = self.training_queue.popleft()
         logger.info(f"Prepare training for {new_dataset}...")
 
-        # Download the dataset
+        if not new_dataset.endswith('.zip'):
+            logger.error(f"Dataset path must end with .zip: {new_dataset}")
+            return None
+
+        # Download and extract the dataset in a single pass
         new_dataset_path = os.path.join(self.gdrive_dataset_path, new_dataset)
-        local_new_dataset_path = download_file(new_dataset_path, self.local_dataset_path, show_progress=False)
+        dataset_path = download_and_extract(
+            new_dataset_path,
+            self.local_dataset_path,
+            stream_args=self.stream_args,
+            download_args=self.download_args
+        )
 
-        # Prepare the dataset for training
-        dataset_path = Trainer.prepare_dataset(local_new_dataset_path)
+        if not check_dataset_structure(dataset_path):
+            return None
 
-        # Start the training process
+        return dataset_path
+
+    def _process_next_dataset(self, dataset_path: str):
+        """Start training on a prepared dataset."""
         dataset_name = os.path.basename(dataset_path)
-        self._trigger_training_process(
-            run_name=dataset_name,
-            dataset_path=dataset_path,
-            model_log_path=self.local_model_logs_path
-        )
 
-    def _cleanup(self, sync_thread: threading.Thread, training_proc: subprocess.Popen):
+        train_cfg = self.train_cfg
+        if self.auto_tune_train_cfg:
+            train_cfg = train_cfg.specialize(Trainer.count_train_images(dataset_path))
+            logger.info(f"Training config for {dataset_name}: {train_cfg}")
+
+        self.current_run_name = dataset_name
+        try:
+            self._trigger_training_process(
+                run_name=dataset_name,
+                dataset_path=dataset_path,
+                model_log_path=self.local_model_logs_path,
+                train_cfg=train_cfg
+            )
+        finally:
+            self.current_run_name = None
+
+        # Let the sync thread mirror the model logs, so that evicted checkpoints are removed remotely too,
+        # without holding back the next training
+        self.full_sync_pending.set()
+        self.model_logs_changed.set()
+
+    def _cleanup(
+        self,
+        sync_thread: threading.Thread,
+        training_worker: mp.Process,
+        download_thread: threading.Thread = None,
+        monitoring_thread: threading.Thread = None
+    ):
         """Clean up resources before exiting."""
+        if monitoring_thread:
+            self.stop_monitoring_event.set()
+            monitoring_thread.join(timeout=2)
         if sync_thread:
-            self.stop_sync_thread = True
+            self.stop_sync_event.set()
+            self.model_logs_changed.set()   # wake the sync thread up
             sync_thread.join(timeout=2)
-        if training_proc:
-            training_proc.terminate()
+        if self.model_logs_observer:
+            self.model_logs_observer.stop()
+            self.model_logs_observer.join(timeout=2)
+        if download_thread:
+            self.stop_download_event.set()
+            download_thread.join(timeout=2)
+        if training_worker:
+            training_worker.terminate()
+            training_worker.join(timeout=2)
 
-    def _trigger_training_process(self, run_name: str, dataset_path: str, model_log_path: str):
+    def _start_training_worker(self) -> mp.Process:
         """
-        Trigger the training process in a separate process.
+        Start the persistent training worker process, with fresh task and result queues so that nothing
+        left over by a previous worker is picked up.
         """
-        # Create a command to run the training script
-        cmd = [
-            "python", "src/train.py",
-            "--run_name", run_name,
-            "--data_path", dataset_path,
-            "--model_log_path", model_log_path
-        ]
+        self.training_task_queue = self.mp_context.Queue()
+        self.training_done_queue = self.mp_context.Queue()
+        training_worker = self.mp_context.Process(
+            target=training_worker_loop,
+            args=(self.training_task_queue, self.training_done_queue),
+            daemon=False
+        )
+        training_worker.start()
+        logger.info(f"Training worker started (PID: {training_worker.pid})")
+        return training_worker
 
-        env = os.environ.copy()
-        if "WANDB_API_KEY" in os.environ:
-            env["WANDB_API_KEY"] = os.environ["WANDB_API_KEY"]
+    def _trigger_training_process(self, run_name: str, dataset_path: str, model_log_path: str, train_cfg: TrainCfg):
+        """
+        Trigger the training in the training worker process and wait for it to finish.
+        """
+        self.training_task_queue.put((run_name, dataset_path, model_log_path, train_cfg))
+        logger.info(f"Training {run_name} started, logging to {os.path.join(model_log_path, f'{run_name}.log')}")
 
-        try:
-            subprocess.run(
-                cmd,
-                env=env,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-        except Exception as e:
-            logger.error(f"Error during training: {e}")
+        while True:
+            try:
+                done_run_name, error = self.training_done_queue.get(timeout=TRAINING_CHECK_INTERVAL)
+            except queue.Empty:
+                if self._check_for_alive_training_process_status(self.training_worker):
+                    continue
+                # the worker died (e.g. killed by the OOM killer), drop the task and start a fresh one
+                logger.error(f"Training worker died during training of {run_name}, restarting it")
+                self.training_worker = self._start_training_worker()
+                return
 
-    def _check_for_alive_training_process_status(self, training_proc: subprocess.Popen):
+            if done_run_name != run_name:
+                logger.warning(f"Ignoring result of {done_run_name} while waiting for {run_name}")
+                continue
+
+            if error is not None:
+                logger.error(f"Error during training: {error}")
+            return
+
+    def _check_for_alive_training_process_status(self, training_worker: mp.Process):
         """
         Check if the training process is still running.
         """
-        if training_proc.poll() is None:
-            logger.info(f"Training process is still running (PID: {training_proc.pid})")
+        if training_worker.is_alive():
+            logger.debug(f"Training process is still running (PID: {training_worker.pid})")
             return True
         return False
 
+    def _model_logs_copy_pairs(self, run_name: str | None) -> list[tuple[str, str]]:
+        """
+        Get the (local, remote) paths to upload while training `run_name`: its run folder and its log file.
+        Without a running training, the whole model logs folder is uploaded.
+        """
+        if run_name is None:
+            return [(self.local_model_logs_path, self.gdrive_model_logs_path)]
+
+        copy_pairs = []
+        run_dir = os.path.join(self.local_model_logs_path, run_name)
+        if os.path.isdir(run_dir):
+            copy_pairs.append((run_dir, os.path.join(self.gdrive_model_logs_path, run_name)))
+        log_file_path = os.path.join(self.local_model_logs_path, f"{run_name}.log")
+        if os.path.isfile(log_file_path):
+            copy_pairs.append((log_file_path, self.gdrive_model_logs_path))
+        return copy_pairs
+
     def _sync_model_logs_loop(self):
+        """
+        Upload the model logs to Google Drive whenever they change, once the writes have settled.
+        """
         def sync_task():
-            while not self.stop_sync_thread:
+            last_synced_fingerprint = None
+            while True:
+                # wait until something changes in the model logs folder, or the thread is stopped
+                self.model_logs_changed.wait()
+                if self.stop_sync_event.is_set():
+                    break
+
+                # wait for the writes to settle, but never hold a sync back longer than SYNC_INTERVAL,
+                # nor the full sync requested at the end of a training
+                first_change_time = last_change_time = time.time()
+                self.model_logs_changed.clear()
+                while not self.stop_sync_event.is_set() and not self.full_sync_pending.is_set():
+                    deadline = min(last_change_time + SYNC_DEBOUNCE_INTERVAL, first_change_time + SYNC_INTERVAL)
+                    timeout = deadline - time.time()
+                    if timeout <= 0 or not self.model_logs_changed.wait(timeout):
+                        break
+                    self.model_logs_changed.clear()
+                    last_change_time = time.time()
+
+                if self.stop_sync_event.is_set():
+                    break
+
+                # mirror the whole folder once a training is over, otherwise only upload the run being trained
+                full_sync = self.full_sync_pending.is_set()
+                self.full_sync_pending.clear()
+                copy_pairs = self._model_logs_copy_pairs(None if full_sync else self.current_run_name)
+
+                # skip the sync if the files ended up unchanged, e.g. temporary files created and removed
+                fingerprint = hash(tuple((source, get_path_fingerprint(source)) for source, _ in copy_pairs))
+                if fingerprint == last_synced_fingerprint and not full_sync:
+                    logger.info(f"No changes in {self.local_model_logs_path}, skipping sync")
+                    continue
+
                 try:
-                    sync_folder(self.local_model_logs_path, self.gdrive_model_logs_path, show_progress=True)
+                    for source_path, target_path in copy_pairs:
+                        if full_sync:
+                            sync_folder(source_path, target_path, show_progress=True, args=self.sync_args)
+                        else:
+                            copy_folder(source_path, target_path, show_progress=True, args=self.copy_args)
+                    last_synced_fingerprint = fingerprint
                 except Exception as e:
                     logger.error(f"Error during auto-sync: {e}")
+                    if full_sync:
+                        self.full_sync_pending.set()   # retry the full sync on the next change
 
-                # wait for 60 seconds, if the sync thread is stopped, break
-                for _ in range(1200):
-                    if self.stop_sync_thread:
-                        break
-                    time.sleep(1)
+        self.model_logs_observer = Observer()
+        self.model_logs_observer.schedule(
+            _ChangeEventHandler(self.model_logs_changed), self.local_model_logs_path, recursive=True
+        )
+        self.model_logs_observer.start()
 
-        self.stop_sync_thread = False   # ensure that the sync thread is not stopped
+        self.model_logs_changed.set()   # sync whatever is already on disk at startup
+        self.stop_sync_event.clear()   # ensure that the sync thread is not stopped
         sync_thread = threading.Thread(target=sync_task, daemon=False)
         sync_thread.start()
         return sync_thread
 
+    def _downloader_loop(self):
+        """
+        Download and prepare queued datasets ahead of training, so that the GPU does not
+        sit idle while rclone and unzip are running.
+        """
+        def download_task():
+            while not self.stop_download_event.is_set():
+                if not self.training_queue:
+                    self.stop_download_event.wait(1)
+                    continue
+
+                try:
+                    dataset_path = self._prepare_next_dataset()
+                except Exception as e:
+                    logger.error(f"Error during dataset preparation: {e}")
+                    continue
+
+                if dataset_path is None:
+                    continue
+
+                # hand over to the training loop, blocking while it is busy with earlier datasets
+                while not self.stop_download_event.is_set():
+                    try:
+                        self.prepared_queue.put(dataset_path, timeout=1)
+                        break
+                    except queue.Full:
+                        continue
+
+        self.stop_download_event.clear()
+        download_thread = threading.Thread(target=download_task, daemon=False)
+        download_thread.start()
+        return download_thread
+
+    def _monitoring_loop(self):
+        """
+        Poll Google Drive for new datasets in the background, so that datasets uploaded during a training
+        are queued and prepared by the downloader thread before that training ends.
+        """
+        def monitoring_task():
+            while not self.stop_monitoring_event.is_set():
+                try:
+                    self._check_and_update_datasets()
+                except Exception as e:
+                    logger.error(f"Error while checking for new datasets: {e}")
+                self.stop_monitoring_event.wait(MONITORING_INTERVAL)
+
+        self.stop_monitoring_event.clear()
+        monitoring_thread = threading.Thread(target=monitoring_task, daemon=False)
+        monitoring_thread.start()
+        return monitoring_thread
+
 
 if __name__ == "__main__":
     import argparse
@@ -171,6 +405,7 @@ if __name__ == "__main__":
     parser.add_argument("--local_model_logs_path", type=str, required=True)
     parser.add_argument("--gdrive_dataset_path", type=str, required=True)
     parser.add_argument("--gdrive_model_logs_path", type=str, required=True)
+    parser.add_argument("--auto_tune_train_cfg", action="store_true")
     args = parser.parse_args()
 
     # ensure that the local dataset and model logs paths exist
@@ -181,6 +416,7 @@ if __name__ == "__main__":
         local_dataset_path=args.local_dataset_path,
         local_model_logs_path=args.local_model_logs_path,
         gdrive_dataset_path=args.gdrive_dataset_path,
-        gdrive_model_logs_path=args.gdrive_model_logs_path
+        gdrive_model_logs_path=args.gdrive_model_logs_path,
+        auto_tune_train_cfg=args.auto_tune_train_cfg
     )
     train_manager.start()
\ No newline at end of file
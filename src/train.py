@@ -1,24 +1,70 @@
+import io
+import json
 import os
+import sys
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from copy import deepcopy
+from dataclasses import asdict, dataclass, replace
 from datetime import datetime
 
 import torch
 import yaml
+import zstandard as zstd
 from ultralytics import YOLO
 from ultralytics.yolo.utils import __version__
 from ultralytics.yolo.utils.torch_utils import de_parallel
 
 from src.logger import get_logger
-from src.utils import check_dataset_structure, unzip_file
+from src.utils import count_files, unzip_dataset
 
 logger = get_logger("ultralytics_gdrive_ops")
 
+# Prefer the libyaml bindings when PyYAML was built with them
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+BASE_WEIGHTS = "yolov8x.pt"
+SMALL_DATASET_SIZE = 500
+
+
+@dataclass
+class TrainCfg:
+    """
+    YOLO training hyperparameters, passed as is to `model.train`.
+    """
+    epochs: int = 400
+    imgsz: int = 1280
+    batch: int = 8
+    save_period: int = -1
+    fliplr: float = 0.8
+    flipud: float = 0.6
+    scale: float = 0.1
+    patience: int = 200
+
+    def specialize(self, num_train_images: int) -> "TrainCfg":
+        """
+        Adapt the config to the dataset size: small datasets train on half the image size with 4x the batch.
+        """
+        if num_train_images >= SMALL_DATASET_SIZE:
+            return self
+        return replace(self, imgsz=self.imgsz // 2, batch=self.batch * 4)
+
 
 class Trainer:
-    def __init__(self, run_name: str, data_path: str, model_log_path: str):
+    def __init__(self, run_name: str, data_path: str, model_log_path: str, train_cfg: TrainCfg | None = None):
         self.run_name = run_name
         self.data_path = data_path
         self.model_log_path = model_log_path
+        self.train_cfg = train_cfg or TrainCfg()
+
+    @staticmethod
+    def count_train_images(dataset_path: str) -> int:
+        """
+        Count the training images of a prepared dataset.
+        """
+        return count_files(os.path.join(dataset_path, "train", "images"))
 
     @staticmethod
     def prepare_dataset(dataset_path: str) -> str | None:
@@ -29,26 +75,26 @@ class Trainer:
             logger.error(f"Dataset path must end with .zip: {dataset_path}")
             return None
 
+        # The structure is checked from the archive listing, so invalid datasets are never extracted
         save_dir = os.path.dirname(dataset_path)
-        unzip_file(dataset_path, save_dir)
-
-        dataset_path = os.path.splitext(dataset_path)[0]
-
-        if not check_dataset_structure(dataset_path):
+        if not unzip_dataset(dataset_path, save_dir):
             return None
 
-        return dataset_path
+        return os.path.splitext(dataset_path)[0]
 
-    def train(self):
+    def train(self, base_model: YOLO | None = None):
         """
-        Train the model.
+        Train the model, starting from a copy of `base_model` if given instead of loading the base weights.
         """
-        model = YOLO("yolov8x.pt")
+        model = deepcopy(base_model) if base_model is not None else YOLO(BASE_WEIGHTS)
+
+        cwd = os.getcwd()
+        abs_data_path = os.path.join(cwd, self.data_path)
 
         config_file = os.path.join(self.data_path, "data.yaml")
         if not os.path.exists(config_file):
             data_yaml = {
-                "path": os.path.join(os.getcwd(), self.data_path),
+                "path": abs_data_path,
                 "train": "train/images",
                 "val": "val/images",
                 "names": {
@@ -57,86 +103,300 @@ class Trainer:
             }
         else:
             with open(config_file, "r") as f:
-                data_yaml = yaml.safe_load(f)
-            data_yaml["path"] = os.path.join(os.getcwd(), self.data_path)
+                data_yaml = yaml.load(f, Loader=YAML_LOADER)
 
-        with open(config_file, "w") as f:
-            yaml.dump(data_yaml, f)
+        # Only rewrite the config if it does not already point to the dataset
+        if not os.path.exists(config_file) or data_yaml.get("path") != abs_data_path:
+            data_yaml["path"] = abs_data_path
+            with open(config_file, "w") as f:
+                yaml.dump(data_yaml, f, Dumper=YAML_DUMPER)
 
         model.add_callback("on_fit_epoch_end", save_top10_models_callback)
         model.train(
             data=config_file,
-            epochs=400,
-            imgsz=1280,
-            batch=8,
             name=self.run_name,
-            project=os.path.join(os.getcwd(), self.model_log_path),
+            project=os.path.join(cwd, self.model_log_path),
             exist_ok=True,
-            save_period=-1,
-            fliplr=0.8,
-            flipud=0.6,
-            scale=0.1,
-            patience=200
+            **asdict(self.train_cfg)
         )
 
-        model.export(format="onnx", imgsz=1280)
+        # Make sure every top10 checkpoint is on disk before the run is reported as done
+        _flush_ckpt_writer()
+
+        model.export(format="onnx", imgsz=self.train_cfg.imgsz)
 
 
 import heapq
 
+TOP10_INDEX_FILE = "top10_index.json"
+CKPT_COMPRESSION_LEVEL = 3
+
+# Checkpoint writes and deletions run off the training loop. A single worker keeps them in submission order.
+_ckpt_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ckpt_writer")
+_pending_ckpt_saves = deque()
+
+
+def _log_ckpt_io_error(future: Future):
+    if future.exception() is not None:
+        logger.error(f"Error during checkpoint I/O: {future.exception()}")
+
+
+def _submit_ckpt_io(fn, *args) -> Future:
+    """
+    Run a checkpoint I/O operation on the background writer.
+    """
+    future = _ckpt_writer.submit(fn, *args)
+    future.add_done_callback(_log_ckpt_io_error)
+    return future
+
+
+def save_checkpoint(ckpt: dict, ckpt_path):
+    """
+    Save a checkpoint compressed with zstd.
+    """
+    cctx = zstd.ZstdCompressor(level=CKPT_COMPRESSION_LEVEL, threads=-1)
+    with open(ckpt_path, "wb") as f, cctx.stream_writer(f) as writer:
+        torch.save(ckpt, writer)
+
+
+def load_checkpoint(ckpt_path, map_location="cpu") -> dict:
+    """
+    Load a checkpoint saved by `save_checkpoint`.
+    """
+    with open(ckpt_path, "rb") as f, zstd.ZstdDecompressor().stream_reader(f) as reader:
+        # torch.load needs a seekable file
+        buffer = io.BytesIO(reader.read())
+    # the checkpoint pickles the model and ema modules, which torch>=2.6 refuses to load by default
+    return torch.load(buffer, map_location=map_location, weights_only=False)
+
+
+def _submit_ckpt_save(ckpt: dict, ckpt_path):
+    """
+    Save a checkpoint on the background writer.
+    """
+    _pending_ckpt_saves.append(_submit_ckpt_io(save_checkpoint, ckpt, ckpt_path))
+
+
+def _wait_for_pending_ckpt_saves():
+    """
+    Wait until all submitted checkpoints are written, so their shadow models can be overwritten.
+    """
+    wait(_pending_ckpt_saves)
+    _pending_ckpt_saves.clear()
+
+
+def _flush_ckpt_writer():
+    """
+    Wait until every checkpoint I/O operation submitted so far has completed.
+    """
+    _ckpt_writer.submit(lambda: None).result()
+    _pending_ckpt_saves.clear()
+
+
+def _update_shadow_model(shadow: torch.nn.Module | None, model: torch.nn.Module) -> torch.nn.Module:
+    """
+    Copy the weights of `model` into a persistent half-precision CPU shadow, allocating it on first use.
+    """
+    if shadow is None:
+        shadow = deepcopy(model).to("cpu").half()
+        if torch.cuda.is_available():
+            shadow._apply(lambda t: t.pin_memory())
+        return shadow
+
+    with torch.no_grad():
+        for dst, src in zip(shadow.state_dict().values(), model.state_dict().values()):
+            dst.copy_(src, non_blocking=True)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return shadow
+
+
+def _to_cpu(obj):
+    """
+    Recursively copy the tensors of a (nested) state dict to the CPU, so that the snapshot neither holds on to
+    VRAM nor aliases the live training state.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", non_blocking=True, copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def _snapshot_optimizer_state(optimizer: torch.optim.Optimizer) -> dict:
+    """
+    Snapshot the optimizer state dict to the CPU.
+    """
+    state_dict = _to_cpu(optimizer.state_dict())
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return state_dict
+
+
+def _remove_checkpoint(ckpt_path: str):
+    try:
+        os.remove(ckpt_path)
+    except Exception:
+        pass
+
+
+def _read_top10_index(index_path: str) -> list:
+    if not os.path.exists(index_path):
+        return []
+
+    try:
+        with open(index_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not load top10 index {index_path}: {e}")
+        return []
+
+
+def _load_top10_index(wdir, resume: bool) -> list:
+    """
+    Load the top10 heap persisted in `wdir` when resuming a training, keeping only the checkpoints that
+    still exist on disk. A fresh training instead deletes the stale entries and their checkpoints, so that
+    it is not ranked against the scores of a previous run.
+    """
+    index_path = os.path.join(wdir, TOP10_INDEX_FILE)
+    entries = _read_top10_index(index_path)
+
+    if not resume:
+        for _, _, path in entries:
+            _remove_checkpoint(path)
+        _remove_checkpoint(index_path)
+        return []
+
+    top10 = [(fitness, epoch, path) for fitness, epoch, path in entries if os.path.exists(path)]
+    heapq.heapify(top10)
+    return top10
+
+
+def _save_top10_index(wdir, top10: list):
+    """
+    Persist the top10 heap to `wdir`. The index is written to a temporary file first and moved into place,
+    so that a crash mid-write never leaves a truncated index behind.
+    """
+    index_path = os.path.join(wdir, TOP10_INDEX_FILE)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump([(float(fitness), int(epoch), path) for fitness, epoch, path in top10], f)
+    os.replace(tmp_path, index_path)
+
 
 def save_top10_models_callback(trainer):
     """
     Callback to save top 10 models based on fitness score.
     """
-    # Initialize top10 heap on first call
+    # Initialize top10 heap on first call, from the persisted index if the training is resumed
     if not hasattr(trainer, "_top10_models"):
-        trainer._top10_models = []  # min-heap of (fitness, epoch, path)
-        trainer._top10_ckpt_paths = set()
+        resume = bool(trainer.args.resume) or trainer.start_epoch > 0
+        trainer._top10_models = _load_top10_index(trainer.wdir, resume)  # min-heap of (fitness, epoch, path)
 
-    # Prepare checkpoint
+    map_score = trainer.metrics["metrics/mAP50-95(B)"]
+    epoch = trainer.epoch
+    top10 = trainer._top10_models
+
+    # Skip the checkpoint entirely unless it makes it into the top10
+    if len(top10) >= 10 and map_score <= top10[0][0]:
+        return
+
+    # Refresh the shadow models in place, once the previous checkpoint is done reading them
+    _wait_for_pending_ckpt_saves()
+    trainer._shadow_model = _update_shadow_model(getattr(trainer, "_shadow_model", None), de_parallel(trainer.model))
+    trainer._shadow_ema = _update_shadow_model(getattr(trainer, "_shadow_ema", None), trainer.ema.ema)
+
+    # Prepare checkpoint, copying everything the training loop keeps mutating since it is saved asynchronously
     ckpt = {
         'epoch': trainer.epoch,
         'best_fitness': trainer.best_fitness,
-        'model': deepcopy(de_parallel(trainer.model)).half(),
-        'ema': deepcopy(trainer.ema.ema).half(),
+        'model': trainer._shadow_model,
+        'ema': trainer._shadow_ema,
         'updates': trainer.ema.updates,
-        'optimizer': trainer.optimizer.state_dict(),
-        'train_args': vars(trainer.args),  # save as dict
+        'optimizer': _snapshot_optimizer_state(trainer.optimizer),
+        'train_args': dict(vars(trainer.args)),  # save as dict
         'date': datetime.now().isoformat(),
         'version': __version__
     }
 
-    map_score = trainer.metrics["metrics/mAP50-95(B)"]
-    epoch = trainer.epoch
-    top10 = trainer._top10_models
-    ckpt_name = f"top10_epoch{epoch}_map5095_{map_score:.6f}.pt"
+    # Add the new one, replacing the worst in a single sift if the top10 is full
+    ckpt_name = f"top10_epoch{epoch}_map5095_{map_score:.6f}.pt.zst"
     ckpt_path = trainer.wdir / ckpt_name
-
-    # If less than 10, just add
-    if len(top10) < 10:
-        heapq.heappush(top10, (map_score, epoch, str(ckpt_path)))
-        trainer._top10_ckpt_paths.add(str(ckpt_path))
-        torch.save(ckpt, ckpt_path)
+    if len(top10) >= 10:
+        _, _, worst_path = heapq.heapreplace(top10, (map_score, epoch, str(ckpt_path)))
+        _submit_ckpt_io(_remove_checkpoint, worst_path)
     else:
-        # If current score is better than the worst in top10, replace
-        if map_score > top10[0][0]:
-            # Remove the worst
-            _, _, worst_path = heapq.heappop(top10)
-            if worst_path in trainer._top10_ckpt_paths:
-                try:
-                    os.remove(worst_path)
-                except Exception:
-                    pass
-                trainer._top10_ckpt_paths.remove(worst_path)
-            # Add the new one
-            heapq.heappush(top10, (map_score, epoch, str(ckpt_path)))
-            trainer._top10_ckpt_paths.add(str(ckpt_path))
-            torch.save(ckpt, ckpt_path)
+        heapq.heappush(top10, (map_score, epoch, str(ckpt_path)))
+    _submit_ckpt_save(ckpt, ckpt_path)
+    _submit_ckpt_io(_save_top10_index, trainer.wdir, list(top10))
 
     del ckpt
 
 
+@contextmanager
+def _redirect_output(log_file_path: str):
+    """
+    Redirect the stdout and stderr file descriptors of the process to a log file.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_stdout, saved_stderr = os.dup(1), os.dup(2)
+    try:
+        with open(log_file_path, "ab", buffering=0) as log_file:
+            os.dup2(log_file.fileno(), 1)
+            os.dup2(log_file.fileno(), 2)
+            try:
+                yield
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+    finally:
+        os.dup2(saved_stdout, 1)
+        os.dup2(saved_stderr, 2)
+        os.close(saved_stdout)
+        os.close(saved_stderr)
+
+
+def training_worker_loop(task_queue, done_queue):
+    """
+    Persistent training worker, so that torch, CUDA, ultralytics and the base weights are loaded only once.
+
+    Receives `(run_name, data_path, model_log_path, train_cfg)` tasks from `task_queue` until it gets None, and puts
+    `(run_name, error)` on `done_queue` when each training is over, `error` being None on success.
+    """
+    base_model = None
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        run_name, data_path, model_log_path, train_cfg = task
+
+        # Load the base weights once, every training starts from a copy of them. A failed load is reported
+        # for the task and retried on the next one, instead of taking the worker down.
+        if base_model is None:
+            try:
+                base_model = YOLO(BASE_WEIGHTS)
+            except Exception as e:
+                logger.error(f"Error loading base weights {BASE_WEIGHTS}: {e}")
+                done_queue.put((run_name, f"Could not load base weights {BASE_WEIGHTS}: {e}"))
+                continue
+
+        log_file_path = os.path.join(model_log_path, f"{run_name}.log")
+        error = None
+        try:
+            with _redirect_output(log_file_path):
+                trainer = Trainer(run_name, data_path, model_log_path, train_cfg)
+                trainer.train(base_model)
+        except Exception as e:
+            logger.error(f"Error during training of {run_name}: {e}")
+            error = str(e)
+        done_queue.put((run_name, error))
+
+
 if __name__ == "__main__":
     import argparse
 
@@ -6,12 +6,73 @@ from src.logger import get_logger
 logger = get_logger("ultralytics_gdrive_ops")
 
 
-def unzip_file(file_path: str, extract_dir: str):
+def check_archive_structure(names: list[str], dataset_name: str) -> bool:
+    """
+    Verify the structure of a zipped dataset from its member names, without extracting it.
+    """
+    for subset in ("train", "val"):
+        for subdir in ("images", "labels"):
+            prefix = f"{dataset_name}/{subset}/{subdir}/"
+            if not any(name.startswith(prefix) for name in names):
+                logger.error(f"Directory {prefix} not found in the archive of {dataset_name}")
+                return False
+
+    logger.info(f"Archive structure verified: {dataset_name}")
+    return True
+
+
+def unzip_dataset(file_path: str, extract_dir: str) -> bool:
+    """
+    Extract a zipped dataset, only if its structure is valid.
+    """
+    dataset_name = os.path.splitext(os.path.basename(file_path))[0]
     try:
         with zipfile.ZipFile(file_path, 'r') as zip_ref:
+            if not check_archive_structure(zip_ref.namelist(), dataset_name):
+                return False
             zip_ref.extractall(extract_dir)
     except Exception as e:
         logger.error(f"Error unzipping file {file_path}: {e}")
+        return False
+    return True
+
+
+def get_path_fingerprint(path: str) -> int:
+    """
+    Compute a fingerprint of a folder at `path` from the relative path, mtime and size of every file in it.
+    A file is fingerprinted from its own mtime and size.
+    """
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return hash((os.path.basename(path), stat.st_mtime_ns, stat.st_size))
+
+    fingerprint = 0
+    stack = [path]
+    while stack:
+        current_dir = stack.pop()
+        try:
+            with os.scandir(current_dir) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    rel_path = os.path.relpath(entry.path, path)
+                    fingerprint ^= hash((rel_path, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            continue
+    return fingerprint
+
+
+def count_files(folder_path: str) -> int:
+    """
+    Count the files directly inside a folder.
+    """
+    with os.scandir(folder_path) as it:
+        return sum(1 for entry in it if entry.is_file())
 
 
 def check_dataset_structure(dataset_path: str) -> bool:
@@ -22,18 +83,18 @@ def check_dataset_structure(dataset_path: str) -> bool:
         """
         Check the structure of a subset of the dataset.
         """
-        if not os.path.exists(subset_path) or not os.path.isdir(subset_path):
+        if not os.path.isdir(subset_path):
             logger.error(f"Subset directory not found at {subset_path}")
             return False
 
         images_dir = os.path.join(subset_path, "images")
         labels_dir = os.path.join(subset_path, "labels")
 
-        if not os.path.exists(images_dir) or not os.path.isdir(images_dir):
+        if not os.path.isdir(images_dir):
             logger.error(f"Images directory not found at {images_dir}")
             return False
 
-        if not os.path.exists(labels_dir) or not os.path.isdir(labels_dir):
+        if not os.path.isdir(labels_dir):
             logger.error(f"Labels directory not found at {labels_dir}")
             return False
 
@@ -43,11 +104,11 @@ def check_dataset_structure(dataset_path: str) -> bool:
     train_dir = os.path.join(dataset_path, "train")
     val_dir = os.path.join(dataset_path, "val")
 
-    if not os.path.exists(train_dir) or not os.path.isdir(train_dir):
+    if not os.path.isdir(train_dir):
         logger.error(f"Training directory not found at {train_dir}")
         return False
 
-    if not os.path.exists(val_dir) or not os.path.isdir(val_dir):
+    if not os.path.isdir(val_dir):
         logger.error(f"Validation directory not found at {val_dir}")
         return False
 
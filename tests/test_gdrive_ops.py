@@ -0,0 +1,96 @@
+import io
+import os
+import stat
+import zipfile
+
+import pytest
+
+from src.gdrive_ops import download_and_extract
+
+# Stands in for rclone: `cat` prints the file given as last argument, `copy` copies it into the target folder
+FAKE_RCLONE = """#!/bin/sh
+case "$1" in
+    cat) for last; do :; done; cat "$last" ;;
+    copy) cp "$2" "$3"/ ;;
+esac
+"""
+
+DATASET_FILES = {
+    "ds/train/images/a.jpg": b"image a",
+    "ds/train/labels/a.txt": b"0 0.5 0.5 0.1 0.1",
+    "ds/val/images/b.jpg": b"image b",
+    "ds/val/labels/b.txt": b"0 0.4 0.4 0.2 0.2",
+}
+
+
+class _UnseekableWriter(io.RawIOBase):
+    """Makes zipfile write data descriptors, as when a zip is streamed out by another tool."""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+@pytest.fixture
+def fake_rclone(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    rclone_path = bin_dir / "rclone"
+    rclone_path.write_text(FAKE_RCLONE)
+    rclone_path.chmod(rclone_path.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+
+def _write_zip(zip_path, files: dict, compression=zipfile.ZIP_DEFLATED):
+    with zipfile.ZipFile(zip_path, "w", compression=compression) as zip_ref:
+        for name, data in files.items():
+            zip_ref.writestr(name, data)
+
+
+def _assert_extracted(dataset_path):
+    for name, data in DATASET_FILES.items():
+        with open(os.path.join(os.path.dirname(dataset_path), name), "rb") as f:
+            assert f.read() == data
+
+
+def test_download_and_extract(fake_rclone, tmp_path):
+    zip_path = tmp_path / "ds.zip"
+    _write_zip(zip_path, DATASET_FILES)
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+
+    dataset_path = download_and_extract(str(zip_path), str(out_dir))
+
+    assert dataset_path == os.path.join(str(out_dir), "ds")
+    _assert_extracted(dataset_path)
+
+
+def test_download_and_extract_rejects_paths_outside_target(fake_rclone, tmp_path):
+    zip_path = tmp_path / "evil.zip"
+    _write_zip(zip_path, {"../evil.txt": b"evil"})
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+
+    with pytest.raises(ValueError, match="Refusing to extract"):
+        download_and_extract(str(zip_path), str(out_dir))
+
+    assert not (tmp_path / "evil.txt").exists()
+
+
+def test_download_and_extract_falls_back_for_unstreamable_zip(fake_rclone, tmp_path):
+    writer = _UnseekableWriter()
+    _write_zip(writer, DATASET_FILES, compression=zipfile.ZIP_STORED)
+    zip_path = tmp_path / "ds.zip"
+    zip_path.write_bytes(writer.buffer.getvalue())
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+
+    dataset_path = download_and_extract(str(zip_path), str(out_dir))
+
+    _assert_extracted(dataset_path)
+    assert not (out_dir / "ds.zip").exists()
@@ -0,0 +1,54 @@
+import os
+import zipfile
+
+from src.utils import check_archive_structure, unzip_dataset
+
+DATASET_FILES = {
+    "ds/train/images/a.jpg": b"image a",
+    "ds/train/labels/a.txt": b"0 0.5 0.5 0.1 0.1",
+    "ds/val/images/b.jpg": b"image b",
+    "ds/val/labels/b.txt": b"0 0.4 0.4 0.2 0.2",
+}
+
+
+def _write_zip(zip_path, files: dict, compression=zipfile.ZIP_DEFLATED):
+    with zipfile.ZipFile(zip_path, "w", compression=compression) as zip_ref:
+        for name, data in files.items():
+            zip_ref.writestr(name, data)
+
+
+def test_unzip_dataset(tmp_path):
+    zip_path = tmp_path / "ds.zip"
+    _write_zip(zip_path, DATASET_FILES)
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+
+    assert check_archive_structure(list(DATASET_FILES), "ds")
+    assert unzip_dataset(str(zip_path), str(out_dir))
+
+    for name, data in DATASET_FILES.items():
+        with open(os.path.join(out_dir, name), "rb") as f:
+            assert f.read() == data
+
+
+def test_unzip_dataset_rejects_missing_val_labels(tmp_path):
+    files = {name: data for name, data in DATASET_FILES.items() if not name.startswith("ds/val/labels/")}
+    zip_path = tmp_path / "ds.zip"
+    _write_zip(zip_path, files)
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+
+    assert not check_archive_structure(list(files), "ds")
+    assert not unzip_dataset(str(zip_path), str(out_dir))
+    assert os.listdir(out_dir) == []
+
+
+def test_unzip_dataset_rejects_wrong_top_level_folder(tmp_path):
+    zip_path = tmp_path / "other.zip"
+    _write_zip(zip_path, DATASET_FILES)
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+
+    assert not check_archive_structure(list(DATASET_FILES), "other")
+    assert not unzip_dataset(str(zip_path), str(out_dir))
+    assert os.listdir(out_dir) == []